@@ -19,12 +19,19 @@
 # Python interface to the clearing house. Just querying for now.
 #
 
-import xmlrpclib
+import time
+try:
+    import xmlrpclib
+except ImportError:
+    import xmlrpc.client as xmlrpclib
 
 DefaultURL = "http://pubseed.theseed.org/legacy_clearinghouse/api.cgi"
 #DefaultURL = "http://www.mcs.anl.gov/~olson/SEED/api.cgi"
 SSDefaultURL = "http://www.mcs.anl.gov/~olson/SEED/ss_hier.cgi"
 
+# Seconds before the local subsystem hierarchy is reloaded
+SSDefaultTTL = 3600
+
 class Clearinghouse:
 
     def __init__(self, url = None):
@@ -90,31 +97,68 @@ class Clearinghouse:
         return self.proxy.get_seed_info(seed_id)
 
     def delete_subsystem(self, subsystem_id):
-	""" Given this subsystem_id, make an entry in the subsystems-deleted table for each version of this subsystem with the same name and from the same seed
-	"""
-	return self.proxy.delete_subsystem(subsystem_id)
+        """ Given this subsystem_id, make an entry in the subsystems-deleted table for each version of this subsystem with the same name and from the same seed
+        """
+        return self.proxy.delete_subsystem(subsystem_id)
 
 
 class SSHierarchy:
+    """
+    Client for the subsystem hierarchy service.
 
-    def __init__(self, url = None):
+    The whole hierarchy is kept locally as a snapshot so that category and
+    subsystem lookups do not need a round trip per node. The snapshot is
+    reloaded once it is older than ttl seconds or after invalidate(), and
+    is updated in place when cat_add_subsystem, cat_remove_subsystem or
+    cat_create succeed.
+
+    read_category is expected to return a struct with the category's
+    parent, children and subsystems.
+    """
+
+    def __init__(self, url = None, ttl = SSDefaultTTL):
 
         if url is None:
             url = SSDefaultURL
 
         self.proxy = xmlrpclib.ServerProxy(url)
+        self.ttl = ttl
+        self.snapshot = None
+        self.snapshot_time = 0
 
     def read_category(self, cat):
        return self.proxy.read_category(cat)
 
     def cat_add_subsystem(self, cat, name):
-       return self.proxy.cat_add_subsystem(cat, name)
+       ret = self.proxy.cat_add_subsystem(cat, name)
+       if ret and self.snapshot is not None and cat in self.snapshot["categories"]:
+          subs = self.snapshot["categories"][cat]["subsystems"]
+          if name not in subs:
+             subs.append(name)
+             self.snapshot["subsystems"].setdefault(name, []).append(cat)
+       return ret
 
     def cat_remove_subsystem(self, cat, name):
-       return self.proxy.cat_remove_subsystem(cat, name)
+       ret = self.proxy.cat_remove_subsystem(cat, name)
+       if ret and self.snapshot is not None and cat in self.snapshot["categories"]:
+          subs = self.snapshot["categories"][cat]["subsystems"]
+          if name in subs:
+             subs.remove(name)
+             cats = self.snapshot["subsystems"][name]
+             cats.remove(cat)
+             if not cats:
+                del self.snapshot["subsystems"][name]
+       return ret
 
     def cat_create(self, parent, name):
-       return self.proxy.cat_create(parent, name)
+       ret = self.proxy.cat_create(parent, name)
+       if ret and self.snapshot is not None:
+          categories = self.snapshot["categories"]
+          if name not in categories:
+             categories[name] = {"parent": parent, "children": [], "subsystems": []}
+             if parent in categories:
+                categories[parent]["children"].append(name)
+       return ret
 
     def all_subsystems(self):
        return self.proxy.all_subsystems()
@@ -122,3 +166,90 @@ class SSHierarchy:
     def all_categories(self):
        return self.proxy.all_categories()
 
+    def invalidate(self):
+       """
+       Discard the local snapshot, it is reloaded on next use.
+       """
+       self.snapshot = None
+
+    def _read_categories(self, cats):
+       #
+       # Read all categories in a single multicall request, falling
+       # back to one call per category if the server does not support it.
+       #
+       multicall = xmlrpclib.MultiCall(self.proxy)
+       for cat in cats:
+          multicall.read_category(cat)
+       try:
+          return list(multicall())
+       except xmlrpclib.Fault:
+          return [self.proxy.read_category(cat) for cat in cats]
+
+    def load_snapshot(self):
+       """
+       Read the whole hierarchy from the server.
+
+       The snapshot is a dict with "categories", keyed by category with
+       values {parent, children, subsystems}, and "subsystems", keyed by
+       subsystem with the list of categories containing it.
+       """
+       cats = list(self.proxy.all_categories())
+       categories = {}
+       subsystems = {}
+       for cat, info in zip(cats, self._read_categories(cats)):
+          categories[cat] = {
+             "parent": info.get("parent") or None,
+             "children": list(info.get("children") or []),
+             "subsystems": list(info.get("subsystems") or [])}
+          for sub in categories[cat]["subsystems"]:
+             subsystems.setdefault(sub, []).append(cat)
+
+       self.snapshot = {"categories": categories, "subsystems": subsystems}
+       self.snapshot_time = time.time()
+       return self.snapshot
+
+    def get_snapshot(self):
+       """
+       Return the local snapshot, reloading it if missing or expired.
+       """
+       if self.snapshot is None or time.time() - self.snapshot_time > self.ttl:
+          self.load_snapshot()
+       return self.snapshot
+
+    def category_subsystems(self, cat):
+       """
+       Return the subsystems directly in this category.
+       """
+       info = self.get_snapshot()["categories"].get(cat)
+       return list(info["subsystems"]) if info else []
+
+    def category_children(self, cat):
+       """
+       Return the child categories of this category.
+       """
+       info = self.get_snapshot()["categories"].get(cat)
+       return list(info["children"]) if info else []
+
+    def category_path(self, cat):
+       """
+       Return the list of categories from the root down to this category.
+       """
+       categories = self.get_snapshot()["categories"]
+       path = []
+       while cat is not None and cat in categories and cat not in path:
+          path.insert(0, cat)
+          cat = categories[cat]["parent"]
+       return path
+
+    def subsystem_categories(self, name):
+       """
+       Return the categories containing this subsystem.
+       """
+       return list(self.get_snapshot()["subsystems"].get(name, []))
+
+    def subsystem_paths(self, name):
+       """
+       Return the ancestor path, from the root down, of each category
+       containing this subsystem.
+       """
+       return [self.category_path(cat) for cat in self.subsystem_categories(name)]
@@ -0,0 +1,281 @@
+#
+# Sparse reaction x genome and compound x genome matrices built from the
+# ModelSEED models collected by the pipeline.
+#
+# Each MS<rast_taxid>.sbml found through the records file is parsed once and
+# its reaction and compound ids are interned into row indices. Matrices are
+# cached on disk in <cache_dir> and only new or changed models are parsed
+# on each update. Requires numpy and scipy.
+#
+# Usage:
+#   python ModelSEEDMatrix.py <record_filename> <cache_dir>
+#
+
+import csv
+import fcntl
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import scipy.sparse as sp
+
+INDEX_FILENAME = "index.json"
+
+# Matrix files are versioned, "%d" is the save counter kept in the index
+MATRIX_FILENAMES = {
+    "reaction": "reactions.%d.npz",
+    "compound": "compounds.%d.npz"}
+
+# SBML ids carry a type prefix, e.g. R_rxn00001_c0 and M_cpd00001_c0
+ID_PREFIXES = {"reaction": "R_", "species": "M_"}
+
+
+def _local_name(tag):
+    # Strip the namespace from an element tag
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_sbml(filename):
+    """
+    Stream-parse an SBML model, returning (reactions, compounds) as sets of
+    ModelSEED ids with their compartment, e.g. rxn00001_c0.
+    """
+    ret = {"reaction": set(), "species": set()}
+    for _, elem in ET.iterparse(filename):
+        name = _local_name(elem.tag)
+        if name in ret:
+            sid = elem.get("id")
+            prefix = ID_PREFIXES[name]
+            if sid.startswith(prefix):
+                sid = sid[len(prefix):]
+            ret[name].add(sid)
+        # Release elements once their ids are recorded
+        if name in ("reaction", "species"):
+            elem.clear()
+    return ret["reaction"], ret["species"]
+
+
+def read_records(record_filename):
+    """
+    Return the rows of the records file with a complete ModelSEED result.
+
+    Reads under a shared lock on <record_filename>.lock, as in RASTFeatures.
+    """
+    with open(record_filename + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_SH)
+        try:
+            with open(record_filename) as fh:
+                rows = list(csv.DictReader(fh))
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+    return [row for row in rows
+            if row.get("modelseed_result") and row.get("modelseed_name")]
+
+
+class ModelSEEDMatrix:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.genomes = []
+        self.species_taxids = []
+        self.sources = {}
+        self.version = 0
+        self.ids = {"reaction": [], "compound": []}
+        self.matrices = {
+            "reaction": sp.csc_matrix((0, 0), dtype=np.bool_),
+            "compound": sp.csc_matrix((0, 0), dtype=np.bool_)}
+        if os.path.exists(os.path.join(cache_dir, INDEX_FILENAME)):
+            self.load()
+        self._reindex()
+
+    def _reindex(self):
+        # Lookup tables from ids to row / column numbers
+        self.genome_index = dict((g, i) for i, g in enumerate(self.genomes))
+        self.id_index = dict(
+            (kind, dict((x, i) for i, x in enumerate(ids)))
+            for kind, ids in self.ids.items())
+
+    def load(self):
+        with open(os.path.join(self.cache_dir, INDEX_FILENAME)) as fh:
+            index = json.load(fh)
+        self.genomes = index["genomes"]
+        self.species_taxids = index["species_taxids"]
+        self.sources = index["sources"]
+        self.ids = index["ids"]
+        self.version = index["version"]
+        for kind, filename in index["matrices"].items():
+            self.matrices[kind] = sp.load_npz(
+                os.path.join(self.cache_dir, filename)).tocsc()
+
+    def save(self):
+        """
+        Write the matrices and index to cache_dir.
+
+        Matrices are written to new versioned files and only become current
+        once the index referencing them is renamed into place, so a crash
+        at any point leaves the previous index and matrices consistent.
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        old_version = self.version
+        version = old_version + 1
+        matrices = {}
+        for kind, filename in MATRIX_FILENAMES.items():
+            matrices[kind] = filename % version
+            sp.save_npz(os.path.join(self.cache_dir, matrices[kind]),
+                        self.matrices[kind])
+        index = {
+            "version": version,
+            "matrices": matrices,
+            "genomes": self.genomes,
+            "species_taxids": self.species_taxids,
+            "sources": self.sources,
+            "ids": self.ids}
+        tmpfile = os.path.join(self.cache_dir, INDEX_FILENAME + ".tmp")
+        with open(tmpfile, "w") as fh:
+            json.dump(index, fh)
+        os.rename(tmpfile, os.path.join(self.cache_dir, INDEX_FILENAME))
+        self.version = version
+
+        # Previous matrices are no longer referenced
+        for filename in MATRIX_FILENAMES.values():
+            old = os.path.join(self.cache_dir, filename % old_version)
+            if os.path.exists(old):
+                os.remove(old)
+
+    def _intern(self, kind, ids):
+        # Return row numbers of ids, adding any unseen id
+        index = self.id_index[kind]
+        rows = []
+        for x in sorted(ids):
+            if x not in index:
+                index[x] = len(self.ids[kind])
+                self.ids[kind].append(x)
+            rows.append(index[x])
+        return rows
+
+    def update(self, record_filename):
+        """
+        Add every new or changed model listed in the records file.
+        Returns the list of asmids added or replaced.
+        """
+        # Rows to add, keyed by column number
+        columns = {"reaction": {}, "compound": {}}
+        updated = []
+        for row in read_records(record_filename):
+            asmid = row["asmid"]
+            sbml = os.path.join(row["local_path"], row["modelseed_name"] + ".sbml")
+            if not os.path.exists(sbml):
+                continue
+            st = os.stat(sbml)
+            if self.sources.get(asmid) == [sbml, st.st_size, st.st_mtime]:
+                continue
+
+            reactions, compounds = parse_sbml(sbml)
+            if asmid not in self.genome_index:
+                self.genome_index[asmid] = len(self.genomes)
+                self.genomes.append(asmid)
+                self.species_taxids.append(row.get("species_taxid"))
+            col = self.genome_index[asmid]
+            columns["reaction"][col] = self._intern("reaction", reactions)
+            columns["compound"][col] = self._intern("compound", compounds)
+            self.sources[asmid] = [sbml, st.st_size, st.st_mtime]
+            updated.append(asmid)
+
+        if updated:
+            for kind in self.matrices:
+                self.matrices[kind] = self._merge(
+                    self.matrices[kind], columns[kind], len(self.ids[kind]))
+        return updated
+
+    def _merge(self, matrix, columns, nrows):
+        # Drop replaced columns from matrix and add the new ones
+        coo = matrix.tocoo()
+        keep = ~np.isin(coo.col, list(columns))
+        rows = [coo.row[keep]]
+        cols = [coo.col[keep]]
+        for col, col_rows in columns.items():
+            rows.append(np.asarray(col_rows, dtype=np.int64))
+            cols.append(np.full(len(col_rows), col, dtype=np.int64))
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        data = np.ones(len(rows), dtype=np.bool_)
+        return sp.csc_matrix(
+            (data, (rows, cols)), shape=(nrows, len(self.genomes)))
+
+    def genomes_of_species(self, species_taxid):
+        """
+        Return the asmids belonging to species_taxid.
+        """
+        species_taxid = str(species_taxid)
+        return [g for g, s in zip(self.genomes, self.species_taxids)
+                if s == species_taxid]
+
+    def _columns(self, asmids):
+        # Boolean mask of genome columns for asmids
+        mask = np.zeros(len(self.genomes), dtype=np.bool_)
+        mask[[self.genome_index[a] for a in asmids]] = True
+        return mask
+
+    def unique(self, asmids, kind="reaction"):
+        """
+        Return the ids found in at least one of asmids and in no other genome.
+        """
+        matrix = self.matrices[kind]
+        mask = self._columns(asmids)
+        inside = np.asarray(matrix[:, mask].sum(axis=1)).ravel() > 0
+        outside = np.asarray(matrix[:, ~mask].sum(axis=1)).ravel() > 0
+        return [self.ids[kind][i] for i in np.flatnonzero(inside & ~outside)]
+
+    def unique_to_species(self, species_taxid, kind="reaction"):
+        """
+        Return the ids found only in genomes of species_taxid.
+        """
+        return self.unique(self.genomes_of_species(species_taxid), kind)
+
+    def genomes_with(self, ids, kind="reaction"):
+        """
+        Return a dict keyed by id of the asmids whose model contains it.
+        """
+        matrix = self.matrices[kind].tocsr()
+        index = self.id_index[kind]
+        ret = {}
+        for x in ids:
+            if x in index:
+                cols = matrix[index[x]].indices
+                ret[x] = [self.genomes[c] for c in sorted(cols)]
+            else:
+                ret[x] = []
+        return ret
+
+    def jaccard_distances(self, kind="reaction"):
+        """
+        Return a dense genomes x genomes array of pairwise Jaccard distances,
+        ordered as self.genomes.
+        """
+        matrix = self.matrices[kind].astype(np.float64)
+        intersection = np.asarray(matrix.T.dot(matrix).todense())
+        sizes = np.diag(intersection)
+        union = sizes[:, None] + sizes[None, :] - intersection
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity = np.where(union > 0, intersection / union, 1.0)
+        return 1.0 - similarity
+
+
+def main(argv):
+    if len(argv) != 3:
+        sys.stderr.write("Usage: %s <record_filename> <cache_dir>\n" % argv[0])
+        return 1
+    matrix = ModelSEEDMatrix(argv[2])
+    updated = matrix.update(argv[1])
+    if updated:
+        matrix.save()
+    for asmid in sorted(updated):
+        sys.stdout.write("Loaded model for %s\n" % asmid)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,468 @@
+#
+# Indexed store of features found in RAST annotated Genbank files.
+#
+# Each RAST<rast_taxid>.gbff listed in the records file (rast_result column)
+# is stream-parsed once and its features are loaded into a per-project
+# sqlite database. Functions and roles are interned so that each feature row
+# only holds integers and coordinates. Files already ingested are skipped
+# unless their size or modification time changes.
+#
+# Coordinates are 1-based with start <= stop, except for features spanning
+# the origin of a circular contig which have start > stop.
+#
+# Usage:
+#   python RASTFeatures.py <record_filename> <store_filename>
+#
+
+import csv
+import fcntl
+import os
+import re
+import sqlite3
+import sys
+
+# Maximum number of bound parameters used per query
+CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    genome_id INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS genomes (
+    id INTEGER PRIMARY KEY,
+    asmid TEXT UNIQUE NOT NULL,
+    rast_taxid TEXT,
+    organism_name TEXT
+);
+CREATE TABLE IF NOT EXISTS functions (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS roles (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS function_roles (
+    function_id INTEGER NOT NULL,
+    role_id INTEGER NOT NULL,
+    PRIMARY KEY (function_id, role_id)
+);
+CREATE TABLE IF NOT EXISTS features (
+    genome_id INTEGER NOT NULL,
+    fig_id TEXT,
+    type TEXT NOT NULL,
+    contig TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    strand INTEGER NOT NULL,
+    function_id INTEGER,
+    translation_length INTEGER
+);
+CREATE INDEX IF NOT EXISTS features_genome ON features (genome_id);
+CREATE INDEX IF NOT EXISTS features_function ON features (function_id);
+CREATE INDEX IF NOT EXISTS features_locus ON features (contig, start, stop);
+CREATE INDEX IF NOT EXISTS features_fig_id ON features (fig_id);
+CREATE INDEX IF NOT EXISTS function_roles_role ON function_roles (role_id);
+"""
+
+# Columns returned by every feature query
+FEATURE_COLUMNS = (
+    "asmid", "fig_id", "type", "contig", "start", "stop", "strand",
+    "function", "translation_length")
+
+FEATURE_SELECT = """
+SELECT g.asmid, f.fig_id, f.type, f.contig, f.start, f.stop, f.strand,
+       fn.name, f.translation_length
+FROM features f
+JOIN genomes g ON g.id = f.genome_id
+LEFT JOIN functions fn ON fn.id = f.function_id
+"""
+
+# Feature keys that are kept, everything else (source, gene, ...) is skipped
+FEATURE_TYPES = ("CDS", "rRNA", "tRNA", "misc_RNA", "repeat_region")
+
+# Roles in a SEED function are separated by " / ", " @ " or "; "
+# Anything following "#" is a comment
+ROLE_SPLIT = re.compile(r"\s+/\s+|\s+@\s+|;\s+")
+LOCATION_TOKEN = re.compile(
+    r"complement\(|join\(|order\(|\)|<?(\d+)(?:\^|\.\.)>?(\d+)|<?>?(\d+)")
+
+
+def function_roles(function):
+    """
+    Split a SEED function into its roles, dropping any trailing comment.
+    """
+    function = function.split("#", 1)[0].strip()
+    if not function:
+        return []
+    return [r.strip() for r in ROLE_SPLIT.split(function) if r.strip()]
+
+
+def location_parts(location):
+    """
+    Return the list of (start, stop, strand) ranges of a Genbank location,
+    each range is on the minus strand if nested in an odd number of
+    complement() operators.
+    """
+    parts = []
+    stack = []
+    for m in LOCATION_TOKEN.finditer(location):
+        token = m.group(0)
+        if token.endswith("("):
+            stack.append(token == "complement(")
+        elif token == ")":
+            if stack:
+                stack.pop()
+        else:
+            start = int(m.group(1) or m.group(3))
+            stop = int(m.group(2) or m.group(3))
+            strand = -1 if sum(stack) % 2 else 1
+            parts.append((min(start, stop), max(start, stop), strand))
+    return parts
+
+
+def parse_location(location, length=None):
+    """
+    Return (start, stop, strand) of a Genbank location string such as
+    "complement(join(1..100,200..>300))".
+
+    Strand is 0 if the parts are on different strands. If length, the
+    length of the contig, is given and the parts cover both its first and
+    last base, the feature spans the origin: start is then the lowest start
+    of the parts after the origin gap and stop the highest stop before it,
+    so that start > stop.
+    """
+    parts = location_parts(location)
+    strands = set(p[2] for p in parts)
+    strand = strands.pop() if len(strands) == 1 else 0
+    start = min(p[0] for p in parts)
+    stop = max(p[1] for p in parts)
+    if length and len(parts) > 1 and start == 1 and stop == length:
+        # Split at the largest gap between parts, the origin lies there
+        ordered = sorted(parts)
+        gaps = [(ordered[i + 1][0] - ordered[i][1], i)
+                for i in range(len(ordered) - 1)]
+        _, i = max(gaps)
+        start = ordered[i + 1][0]
+        stop = max(p[1] for p in ordered[:i + 1])
+    return start, stop, strand
+
+
+def _finish_feature(feature, length):
+    # Convert parsed qualifiers into a feature dict
+    key, location, qualifiers = feature
+    start, stop, strand = parse_location(location, length)
+    fig_id = None
+    for xref in qualifiers.get("db_xref", []):
+        if xref.startswith("SEED:"):
+            fig_id = xref[len("SEED:"):]
+    function = (qualifiers.get("product") or qualifiers.get("function")
+                or [None])[0]
+    translation = qualifiers.get("translation")
+    return {
+        "type": key,
+        "fig_id": fig_id,
+        "start": start,
+        "stop": stop,
+        "strand": strand,
+        "function": function,
+        "translation_length": len(translation[0]) if translation else None}
+
+
+def iter_genbank_features(fh):
+    """
+    Stream-parse a Genbank file, yielding a dict per feature of a kept type.
+    Each dict contains contig, type, fig_id, start, stop, strand, function
+    and translation_length. Sequence data is never held in memory.
+    """
+    contig = None
+    length = None
+    in_features = False
+    feature = None
+    qualifier = None
+    value = None
+
+    def value_open():
+        # True while the current qualifier is a quoted value not yet closed,
+        # quotes inside values are escaped by doubling them
+        if qualifier is None:
+            return False
+        v = value.strip()
+        return v.startswith('"') and v.count('"') % 2 == 1
+
+    def close_qualifier():
+        if qualifier is not None:
+            v = value.strip()
+            if v.startswith('"'):
+                v = v[1:-1] if v.endswith('"') and len(v) > 1 else v[1:]
+                v = v.replace('""', '"')
+            if qualifier == "translation":
+                v = v.replace(" ", "")
+            feature[2].setdefault(qualifier, []).append(v)
+
+    for line in fh:
+        line = line.rstrip("\r\n")
+        if line.startswith("LOCUS"):
+            fields = line.split()
+            contig = fields[1]
+            length = int(fields[2]) if len(fields) > 2 and \
+                fields[2].isdigit() else None
+            continue
+        if line.startswith("FEATURES"):
+            in_features = True
+            continue
+        if not in_features or not line.strip():
+            continue
+
+        # End of the feature table
+        if line[:1] not in ("", " ") or line.startswith("//"):
+            close_qualifier()
+            if feature is not None and feature[0] in FEATURE_TYPES:
+                ret = _finish_feature(feature, length)
+                ret["contig"] = contig
+                yield ret
+            in_features = False
+            feature = qualifier = value = None
+            continue
+
+        body = line[21:]
+        if line[5:6] != " ":
+            # New feature key
+            close_qualifier()
+            if feature is not None and feature[0] in FEATURE_TYPES:
+                ret = _finish_feature(feature, length)
+                ret["contig"] = contig
+                yield ret
+            key = line[5:21].strip()
+            feature = [key, body.strip(), {}]
+            qualifier = value = None
+        elif body.startswith("/") and not value_open():
+            # New qualifier
+            close_qualifier()
+            name, _, value = body[1:].partition("=")
+            qualifier = name
+        elif qualifier is not None:
+            # Continuation of a qualifier value
+            if qualifier == "translation":
+                value += body.strip()
+            else:
+                value += " " + body.strip()
+        elif feature is not None:
+            # Continuation of a location
+            feature[1] += body.strip()
+
+
+def read_records(record_filename):
+    """
+    Return the rows of the records file that have a RAST result.
+
+    The pipeline rewrites the records file while holding an exclusive flock
+    on <record_filename>.lock, a shared lock is held while reading it.
+    """
+    with open(record_filename + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_SH)
+        try:
+            with open(record_filename) as fh:
+                rows = list(csv.DictReader(fh))
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+    return [row for row in rows if row.get("rast_result")]
+
+
+class RASTFeatures:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.function_ids = dict(self.db.execute(
+            "SELECT name, id FROM functions"))
+        self.role_ids = dict(self.db.execute("SELECT name, id FROM roles"))
+
+    def close(self):
+        self.db.close()
+
+    def _function_id(self, function):
+        # Intern function and its roles, returns function id
+        if function is None:
+            return None
+        fid = self.function_ids.get(function)
+        if fid is not None:
+            return fid
+        fid = self.db.execute(
+            "INSERT INTO functions (name) VALUES (?)", (function,)).lastrowid
+        self.function_ids[function] = fid
+        for role in set(function_roles(function)):
+            rid = self.role_ids.get(role)
+            if rid is None:
+                rid = self.db.execute(
+                    "INSERT INTO roles (name) VALUES (?)", (role,)).lastrowid
+                self.role_ids[role] = rid
+            self.db.execute(
+                "INSERT INTO function_roles (function_id, role_id) "
+                "VALUES (?, ?)", (fid, rid))
+        return fid
+
+    def needs_update(self, path):
+        """
+        Return True if path has not been ingested or has changed since.
+        """
+        st = os.stat(path)
+        row = self.db.execute(
+            "SELECT size, mtime FROM sources WHERE path = ?", (path,)).fetchone()
+        return row is None or row != (st.st_size, st.st_mtime)
+
+    def ingest(self, path, asmid, rast_taxid=None, organism_name=None):
+        """
+        Load all features of a RAST Genbank file, replacing any features
+        previously loaded for asmid. Returns the number of features loaded.
+        """
+        st = os.stat(path)
+        with self.db:
+            row = self.db.execute(
+                "SELECT id FROM genomes WHERE asmid = ?", (asmid,)).fetchone()
+            if row:
+                genome_id = row[0]
+                self.db.execute(
+                    "DELETE FROM features WHERE genome_id = ?", (genome_id,))
+                self.db.execute(
+                    "DELETE FROM sources WHERE genome_id = ?", (genome_id,))
+                self.db.execute(
+                    "UPDATE genomes SET rast_taxid = ?, organism_name = ? "
+                    "WHERE id = ?", (rast_taxid, organism_name, genome_id))
+            else:
+                genome_id = self.db.execute(
+                    "INSERT INTO genomes (asmid, rast_taxid, organism_name) "
+                    "VALUES (?, ?, ?)",
+                    (asmid, rast_taxid, organism_name)).lastrowid
+
+            count = 0
+            with open(path) as fh:
+                rows = []
+                for feat in iter_genbank_features(fh):
+                    rows.append((
+                        genome_id, feat["fig_id"], feat["type"], feat["contig"],
+                        feat["start"], feat["stop"], feat["strand"],
+                        self._function_id(feat["function"]),
+                        feat["translation_length"]))
+                    if len(rows) >= CHUNK_SIZE:
+                        self._insert_features(rows)
+                        count += len(rows)
+                        rows = []
+                self._insert_features(rows)
+                count += len(rows)
+
+            self.db.execute(
+                "INSERT INTO sources (path, genome_id, size, mtime) "
+                "VALUES (?, ?, ?, ?)",
+                (path, genome_id, st.st_size, st.st_mtime))
+        return count
+
+    def _insert_features(self, rows):
+        self.db.executemany(
+            "INSERT INTO features (genome_id, fig_id, type, contig, start, "
+            "stop, strand, function_id, translation_length) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def update(self, record_filename):
+        """
+        Ingest every new or changed rast_result listed in the records file.
+        Returns a dict keyed by asmid of the number of features loaded.
+        """
+        ret = {}
+        for row in read_records(record_filename):
+            path = row["rast_result"]
+            if not os.path.exists(path) or not self.needs_update(path):
+                continue
+            ret[row["asmid"]] = self.ingest(
+                path, row["asmid"], row.get("rast_taxid"),
+                row.get("organism_name"))
+        return ret
+
+    def _query(self, where, values):
+        # Run FEATURE_SELECT for each chunk of values bound to where
+        # where must contain a single "%s" for the placeholder list
+        values = list(values)
+        ret = []
+        for i in range(0, len(values), CHUNK_SIZE):
+            chunk = values[i:i + CHUNK_SIZE]
+            sql = FEATURE_SELECT + "WHERE " + where % ", ".join("?" * len(chunk))
+            for row in self.db.execute(sql, chunk):
+                ret.append(dict(zip(FEATURE_COLUMNS, row)))
+        return ret
+
+    def features_by_function(self, functions):
+        """
+        Return all features whose function is one of functions.
+        """
+        return self._query("fn.name IN (%s)", functions)
+
+    def features_by_role(self, roles):
+        """
+        Return all features whose function contains one of roles.
+        """
+        return self._query(
+            "f.function_id IN (SELECT fr.function_id FROM function_roles fr "
+            "JOIN roles r ON r.id = fr.role_id WHERE r.name IN (%s))", roles)
+
+    def features_by_genome(self, asmids):
+        """
+        Return all features of the given asmids.
+        """
+        return self._query("g.asmid IN (%s)", asmids)
+
+    def features_by_fig_id(self, fig_ids):
+        """
+        Return the features with the given FIG ids.
+        """
+        return self._query("f.fig_id IN (%s)", fig_ids)
+
+    def features_by_locus(self, contig, start, stop, asmids=None):
+        """
+        Return features on contig overlapping start..stop, optionally
+        restricted to the given asmids.
+        """
+        sql = FEATURE_SELECT + \
+            "WHERE f.contig = ? AND (" \
+            "(f.start <= f.stop AND f.start <= ? AND f.stop >= ?) OR " \
+            "(f.start > f.stop AND (f.start <= ? OR f.stop >= ?)))"
+        values = [contig, stop, start, stop, start]
+        if asmids is not None:
+            asmids = list(asmids)
+            sql += " AND g.asmid IN (%s)" % ", ".join("?" * len(asmids))
+            values += asmids
+        return [dict(zip(FEATURE_COLUMNS, row))
+                for row in self.db.execute(sql + " ORDER BY f.start", values)]
+
+    def genomes_with_role(self, role):
+        """
+        Return the sorted list of asmids carrying at least one feature with role.
+        """
+        return [row[0] for row in self.db.execute(
+            "SELECT DISTINCT g.asmid FROM roles r "
+            "JOIN function_roles fr ON fr.role_id = r.id "
+            "JOIN features f ON f.function_id = fr.function_id "
+            "JOIN genomes g ON g.id = f.genome_id "
+            "WHERE r.name = ? ORDER BY g.asmid", (role,))]
+
+
+def main(argv):
+    if len(argv) != 3:
+        sys.stderr.write("Usage: %s <record_filename> <store_filename>\n" %
+                         argv[0])
+        return 1
+    store = RASTFeatures(argv[2])
+    try:
+        loaded = store.update(argv[1])
+    finally:
+        store.close()
+    for asmid in sorted(loaded):
+        sys.stdout.write("Loaded %d features for %s\n" % (loaded[asmid], asmid))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,130 @@
+#
+# Tests for the subsystem hierarchy snapshot in Clearinghouse.py
+#
+# Run with:
+#   python -m pytest tests/test_Clearinghouse.py
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Clearinghouse
+from Clearinghouse import xmlrpclib
+
+CATEGORIES = {
+    "Metabolism": {"parent": "", "children": ["Amino Acids"], "subsystems": []},
+    "Amino Acids": {"parent": "Metabolism", "children": [],
+                    "subsystems": ["Histidine Biosynthesis"]},
+}
+
+
+class StubProxy:
+    """
+    Stands in for the ss_hier.cgi server proxy, counting calls per method.
+    """
+
+    def __init__(self, multicall=True, succeed=True):
+        self.calls = {}
+        self.has_multicall = multicall
+        self.succeed = succeed
+        self.system = self
+
+    def _call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def all_categories(self):
+        self._call("all_categories")
+        return list(CATEGORIES)
+
+    def read_category(self, cat):
+        self._call("read_category")
+        return CATEGORIES[cat]
+
+    def cat_add_subsystem(self, cat, name):
+        self._call("cat_add_subsystem")
+        return int(self.succeed)
+
+    def cat_remove_subsystem(self, cat, name):
+        self._call("cat_remove_subsystem")
+        return int(self.succeed)
+
+    def cat_create(self, parent, name):
+        self._call("cat_create")
+        return int(self.succeed)
+
+    # Reached as proxy.system.multicall
+    def multicall(self, calls):
+        self._call("system.multicall")
+        if not self.has_multicall:
+            raise xmlrpclib.Fault(-32601, "Method system.multicall not found")
+        return [[getattr(self, c["methodName"])(*c["params"])] for c in calls]
+
+
+def hierarchy(proxy):
+    hier = Clearinghouse.SSHierarchy()
+    hier.proxy = proxy
+    return hier
+
+
+class TestSSHierarchy(unittest.TestCase):
+
+    def test_load(self):
+        proxy = StubProxy()
+        hier = hierarchy(proxy)
+        self.assertEqual(hier.category_path("Amino Acids"),
+                         ["Metabolism", "Amino Acids"])
+        self.assertEqual(hier.subsystem_paths("Histidine Biosynthesis"),
+                         [["Metabolism", "Amino Acids"]])
+        self.assertEqual(hier.category_children("Metabolism"), ["Amino Acids"])
+        # A single multicall, and the snapshot is reused
+        self.assertEqual(proxy.calls, {
+            "all_categories": 1, "system.multicall": 1, "read_category": 2})
+
+    def test_multicall_fallback(self):
+        proxy = StubProxy(multicall=False)
+        hier = hierarchy(proxy)
+        self.assertEqual(hier.category_subsystems("Amino Acids"),
+                         ["Histidine Biosynthesis"])
+        self.assertEqual(proxy.calls["read_category"], 2)
+
+    def test_ttl(self):
+        proxy = StubProxy()
+        hier = hierarchy(proxy)
+        hier.get_snapshot()
+        hier.snapshot_time -= Clearinghouse.SSDefaultTTL + 1
+        hier.get_snapshot()
+        self.assertEqual(proxy.calls["all_categories"], 2)
+        hier.invalidate()
+        hier.get_snapshot()
+        self.assertEqual(proxy.calls["all_categories"], 3)
+
+    def test_patch(self):
+        proxy = StubProxy()
+        hier = hierarchy(proxy)
+        hier.get_snapshot()
+        hier.cat_create("Metabolism", "Cofactors")
+        hier.cat_add_subsystem("Cofactors", "Biotin Biosynthesis")
+        hier.cat_remove_subsystem("Amino Acids", "Histidine Biosynthesis")
+        self.assertEqual(hier.category_children("Metabolism"),
+                         ["Amino Acids", "Cofactors"])
+        self.assertEqual(hier.subsystem_paths("Biotin Biosynthesis"),
+                         [["Metabolism", "Cofactors"]])
+        self.assertEqual(hier.subsystem_categories("Histidine Biosynthesis"), [])
+        self.assertEqual(proxy.calls["all_categories"], 1)
+
+    def test_no_patch_on_failure(self):
+        proxy = StubProxy(succeed=False)
+        hier = hierarchy(proxy)
+        hier.get_snapshot()
+        hier.cat_create("Metabolism", "Cofactors")
+        hier.cat_remove_subsystem("Amino Acids", "Histidine Biosynthesis")
+        self.assertEqual(hier.category_children("Metabolism"), ["Amino Acids"])
+        self.assertEqual(hier.subsystem_categories("Histidine Biosynthesis"),
+                         ["Amino Acids"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#
+# Tests for the reaction / compound matrices in ModelSEEDMatrix.py
+#
+# Run with:
+#   python -m pytest tests/test_ModelSEEDMatrix.py
+#
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ModelSEEDMatrix
+
+SBML = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<sbml xmlns="http://www.sbml.org/sbml/level2" level="2" version="1">
+  <model id="%(name)s">
+    <listOfSpecies>
+%(species)s
+    </listOfSpecies>
+    <listOfReactions>
+%(reactions)s
+    </listOfReactions>
+  </model>
+</sbml>
+"""
+
+# asmid, species_taxid, modelseed_name, reactions, compounds
+MODELS = [
+    ("GCA_000069025.1_ASM6902v1", "2242", "MS2242.1",
+     ["rxn00001_c0", "rxn00002_c0"], ["cpd00001_c0", "cpd00002_c0"]),
+    ("GCA_000006805.1_ASM680v1", "2242", "MS64091.1",
+     ["rxn00001_c0", "rxn00003_c0"], ["cpd00001_c0"]),
+]
+
+
+def write_sbml(filename, name, reactions, compounds):
+    with open(filename, "w") as fh:
+        fh.write(SBML % {
+            "name": name,
+            "species": "\n".join(
+                '      <species id="M_%s"/>' % c for c in compounds),
+            "reactions": "\n".join(
+                '      <reaction id="R_%s"/>' % r for r in reactions)})
+
+
+class TestMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "matrix")
+        self.record_filename = os.path.join(self.tmpdir, "records.csv")
+        self.sbml = {}
+        with open(self.record_filename, "w") as fh:
+            writer = csv.writer(fh, lineterminator="\n")
+            writer.writerow(["asmid", "species_taxid", "local_path",
+                             "modelseed_name", "modelseed_result"])
+            for asmid, taxid, name, reactions, compounds in MODELS:
+                local_path = os.path.join(self.tmpdir, asmid)
+                os.makedirs(local_path)
+                self.sbml[asmid] = os.path.join(local_path, name + ".sbml")
+                write_sbml(self.sbml[asmid], name, reactions, compounds)
+                writer.writerow([asmid, taxid, local_path, name,
+                                 os.path.join(local_path, name + ".xls")])
+        self.matrix = ModelSEEDMatrix.ModelSEEDMatrix(self.cache_dir)
+        self.updated = self.matrix.update(self.record_filename)
+        self.matrix.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_update(self):
+        self.assertEqual(sorted(self.updated), sorted(m[0] for m in MODELS))
+        self.assertEqual(self.matrix.genomes_with(["rxn00001_c0"]),
+                         {"rxn00001_c0": [m[0] for m in MODELS]})
+
+    def test_reload(self):
+        matrix = ModelSEEDMatrix.ModelSEEDMatrix(self.cache_dir)
+        self.assertEqual(matrix.genomes, self.matrix.genomes)
+        self.assertEqual(
+            (matrix.matrices["reaction"] != self.matrix.matrices["reaction"]).nnz,
+            0)
+        self.assertEqual(matrix.update(self.record_filename), [])
+        # Only the current version of the matrices is kept
+        self.assertEqual(
+            sorted(f for f in os.listdir(self.cache_dir) if f.endswith(".npz")),
+            ["compounds.1.npz", "reactions.1.npz"])
+
+    def test_replace_changed_model(self):
+        asmid, _, name, _, compounds = MODELS[1]
+        write_sbml(self.sbml[asmid], name, ["rxn00004_c0"], compounds)
+        st = os.stat(self.sbml[asmid])
+        os.utime(self.sbml[asmid], (st.st_atime, st.st_mtime + 10))
+        matrix = ModelSEEDMatrix.ModelSEEDMatrix(self.cache_dir)
+        self.assertEqual(matrix.update(self.record_filename), [asmid])
+        self.assertEqual(matrix.genomes_with(["rxn00003_c0", "rxn00004_c0"]),
+                         {"rxn00003_c0": [], "rxn00004_c0": [asmid]})
+
+    def test_unique(self):
+        self.assertEqual(self.matrix.unique([MODELS[0][0]]), ["rxn00002_c0"])
+        self.assertEqual(self.matrix.unique([MODELS[1][0]], "compound"), [])
+        self.assertEqual(sorted(self.matrix.unique_to_species("2242")),
+                         ["rxn00001_c0", "rxn00002_c0", "rxn00003_c0"])
+
+    def test_jaccard(self):
+        distances = self.matrix.jaccard_distances()
+        self.assertAlmostEqual(distances[0, 0], 0.0)
+        self.assertAlmostEqual(distances[0, 1], 1.0 - 1.0 / 3)
+        self.assertAlmostEqual(distances[1, 0], distances[0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#
+# Tests for the RAST Genbank parser in RASTFeatures.py
+#
+# Run with:
+#   python -m pytest tests/test_RASTFeatures.py
+#
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import RASTFeatures
+
+GENBANK = """\
+LOCUS       contig1     5000 bp    DNA     circular UNK
+FEATURES             Location/Qualifiers
+     source          1..5000
+                     /organism="Halobacterium salinarum"
+     CDS             100..400
+                     /db_xref="SEED:fig|2242.1.peg.1"
+                     /product="Phosphoribosylformylglycinamidine synthase, synthetase subunit (EC 6.3.5.3)
+                     / Phosphoribosylformylglycinamidine synthase, glutamine amidotransferase subunit (EC 6.3.5.3)"
+                     /translation="MKV
+                     LA"
+     CDS             join(complement(4900..5000),complement(1..50))
+                     /db_xref="SEED:fig|2242.1.peg.2"
+                     /product="Protein with ""quoted"" name"
+BASE COUNT   1 a
+ORIGIN
+        1 acgt
+//
+"""
+
+
+class TestGenbankParser(unittest.TestCase):
+
+    def setUp(self):
+        self.features = list(
+            RASTFeatures.iter_genbank_features(io.StringIO(GENBANK)))
+
+    def test_wrapped_role_separator(self):
+        feat = self.features[0]
+        self.assertEqual(feat["fig_id"], "fig|2242.1.peg.1")
+        self.assertEqual(feat["translation_length"], 5)
+        self.assertEqual(RASTFeatures.function_roles(feat["function"]), [
+            "Phosphoribosylformylglycinamidine synthase, synthetase subunit (EC 6.3.5.3)",
+            "Phosphoribosylformylglycinamidine synthase, glutamine amidotransferase subunit (EC 6.3.5.3)"])
+
+    def test_origin_spanning_complement(self):
+        feat = self.features[1]
+        self.assertEqual((feat["start"], feat["stop"], feat["strand"]),
+                         (4900, 50, -1))
+        self.assertEqual(feat["function"], 'Protein with "quoted" name')
+
+    def test_parse_location(self):
+        self.assertEqual(
+            RASTFeatures.parse_location("complement(join(1..100,200..>300))"),
+            (1, 300, -1))
+        self.assertEqual(
+            RASTFeatures.parse_location("join(4900..5000,1..50)", 5000),
+            (4900, 50, 1))
+        self.assertEqual(
+            RASTFeatures.parse_location("join(10..20,complement(30..40))"),
+            (10, 40, 0))
+        self.assertEqual(RASTFeatures.parse_location("<1..>90", 90), (1, 90, 1))
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        gbfile = os.path.join(self.tmpdir, "RAST2242.1.gbff")
+        with open(gbfile, "w") as fh:
+            fh.write(GENBANK)
+        self.store = RASTFeatures.RASTFeatures(
+            os.path.join(self.tmpdir, "features.sqlite"))
+        self.store.ingest(gbfile, "GCA_000069025.1_ASM6902v1")
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_locus_across_origin(self):
+        fig_ids = [f["fig_id"] for f in
+                   self.store.features_by_locus("contig1", 20, 30)]
+        self.assertEqual(fig_ids, ["fig|2242.1.peg.2"])
+        fig_ids = [f["fig_id"] for f in
+                   self.store.features_by_locus("contig1", 300, 1000)]
+        self.assertEqual(fig_ids, ["fig|2242.1.peg.1"])
+
+    def test_genomes_with_second_role(self):
+        self.assertEqual(self.store.genomes_with_role(
+            "Phosphoribosylformylglycinamidine synthase, glutamine "
+            "amidotransferase subunit (EC 6.3.5.3)"),
+            ["GCA_000069025.1_ASM6902v1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
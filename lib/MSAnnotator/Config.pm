@@ -1,6 +1,7 @@
 package MSAnnotator::Config;
 use YAML 'LoadFile';
 use Text::CSV;
+use Sys::Hostname;
 
 # Load custom modukes
 require Exporter;
@@ -23,6 +24,23 @@ sub load_config {
   $config->{data_dir} = "$pwd/$config->{data_dir}";
   $config->{record_filename} = "$pwd/$config->{record_filename}";
   $config->{ncbi_assemblies_file} = "$config->{data_dir}/$assmblfn";
+  $config->{feature_store} = "$pwd/$config->{feature_store}"
+    if $config->{feature_store};
+  $config->{model_matrix} = "$pwd/$config->{model_matrix}"
+    if $config->{model_matrix};
+
+  # Credentials may be given per worker, account is the RAST / MS user
+  my $default_credentials =
+    "$pwd/" . ($config->{credentials_file} || "credentials.yaml");
+  $config->{credentials_file} = $ENV{'MSANNOTATOR_CREDENTIALS'} ||
+    $default_credentials;
+  $config->{account} = LoadFile($config->{credentials_file})->{user};
+
+  # Owner of remote jobs submitted before accounts were recorded
+  $config->{default_account} = -e $default_credentials ?
+    LoadFile($default_credentials)->{user} : '';
+  $config->{worker_id} = hostname() . ":$$";
+  $config->{lease_time} ||= 3 * $config->{sleeptime};
 
   # Ensure data_dir exists
   if (! -e $config->{data_dir}) {
@@ -0,0 +1,176 @@
+package MSAnnotator::Dedup;
+use File::Basename;
+use IO::Uncompress::Gunzip qw($GunzipError);
+use Digest::MD5 'md5_hex';
+use ContigMD5;
+
+# Load custom modules
+use MSAnnotator::Base;
+use MSAnnotator::KnownAssemblies qw(update_records get_records with_records_lock);
+
+# Export functions
+require Exporter;
+our @ISA = 'Exporter';
+our @EXPORT_OK = qw(dedup_update);
+
+# Constants
+use constant fasta_suffix => "_genomic.fna.gz";
+
+# Columns copied from the canonical assembly once its jobs are finished
+# Job ids are not copied, a duplicate with a rast_jobid was itself submitted
+use constant RAST_COLUMNS => qw(rast_status rast_taxid);
+use constant MODELSEED_COLUMNS => qw(modelseed_status modelseed_name);
+
+sub sequence_md5 {
+  # Given a gzipped fasta file, returns md5 of the normalized sequence
+  # Each contig is checksummed ignoring case and whitespace, as done by SEED,
+  # sorted checksums are then hashed so contig names and order do not matter
+  my $filename = shift;
+  my $fh = IO::Uncompress::Gunzip->new($filename)
+    or croak "Error - GunzipError: $GunzipError";
+
+  my (@contig_md5s, $contig);
+  while (my $line = <$fh>) {
+    if ($line =~ /^>/) {
+      push(@contig_md5s, $contig->checksum) if $contig;
+      $contig = ContigMD5->new;
+      next;
+    }
+    $contig = ContigMD5->new if !$contig;
+    $contig->add($line);
+  }
+  push(@contig_md5s, $contig->checksum) if $contig;
+  close $fh;
+
+  return md5_hex(join(",", sort @contig_md5s));
+}
+
+sub dedup_checksum {
+  # Given records, sets sequence_md5 for any record lacking one
+  my $records = shift;
+  my %ret;
+  for my $asmid (keys %$records) {
+    my $asm = $records->{$asmid};
+    next if $asm->{sequence_md5};
+    my $fafile = "$asm->{local_path}/NCBI/$asmid" . fasta_suffix;
+    next if ! -e $fafile;
+    $ret{$asmid}{sequence_md5} = sequence_md5($fafile);
+  }
+  update_records(\%ret) if %ret;
+}
+
+sub dedup_assign {
+  # Given records, for each group of identical sequences picks a canonical
+  # asmid and sets duplicate_of for every other member that has not been
+  # sent to RAST or received results
+  # The canonical asmid is, in order of preference, the one already referenced
+  # by other members, the first submitted, or the first sorted, so that an
+  # existing canonical is kept when new assemblies join the group
+  # Members whose RAST job failed are never canonical, duplicates of a failed
+  # canonical are moved to another member, which is then submitted itself
+  # Records leased by another worker are left alone as they may be in the
+  # middle of being submitted, that worker assigns them on its next pass
+  my ($records, $worker) = @_;
+  my $now = time;
+  my %ret;
+
+  # Group by checksum
+  my %groups;
+  for my $asmid (sort keys %$records) {
+    my $md5 = $records->{$asmid}->{sequence_md5};
+    push(@{$groups{$md5}}, $asmid) if $md5;
+  }
+
+  for my $group (values %groups) {
+    next if @$group < 2;
+    my @live = grep { $records->{$_}->{rast_status} ne 'failed' } @$group;
+    next if !@live;
+    my %live = map { $_ => 1 } @live;
+    my @referenced = grep { $live{$_} && !$records->{$_}->{duplicate_of} }
+      map { $records->{$_}->{duplicate_of} || () } @$group;
+    my @submitted = grep { $records->{$_}->{rast_jobid} } @live;
+    my $canonical = $referenced[0] || $submitted[0] || $live[0];
+
+    for my $asmid (@$group) {
+      my $asm = $records->{$asmid};
+      my $target = $asmid eq $canonical ? '' : $canonical;
+      next if ($asm->{duplicate_of} || '') eq $target;
+      next if $asm->{rast_jobid} || $asm->{rast_status};
+      next if $asm->{worker} && $asm->{worker} ne $worker &&
+        ($asm->{lease_expires} || 0) > $now;
+      $asm->{duplicate_of} = $target;
+      $ret{$asmid}{duplicate_of} = $target;
+    }
+  }
+
+  update_records(\%ret) if %ret;
+}
+
+sub link_results {
+  # Symlinks given files from the canonical directory into local_path
+  # Returns the list of links
+  my ($local_path, @files) = @_;
+  my @linked;
+  for my $file (@files) {
+    my $link = "$local_path/" . basename($file);
+    if (! -e $link) {
+      symlink($file, $link) or croak "Error - Linking $file to $link: $!\n";
+    }
+    push(@linked, $link);
+  }
+  return @linked;
+}
+
+sub dedup_results {
+  # Given records, copies finished RAST / MS status of canonical assemblies
+  # to their duplicates and symlinks the resulting files into local_path
+  my $records = shift;
+  my $canonicals = get_records(
+    map { $_->{duplicate_of} } grep { $_->{duplicate_of} } values %$records);
+
+  my %ret;
+  for my $asmid (keys %$records) {
+    my $asm = $records->{$asmid};
+    my $canon = $canonicals->{$asm->{duplicate_of} || ''};
+    next if !$canon;
+
+    # RAST, wait until the canonical result is available
+    # A failed canonical is replaced by dedup_assign instead
+    if (!$asm->{rast_status}) {
+      if ($canon->{rast_result}) {
+        $ret{$asmid}{$_} = $canon->{$_} for (RAST_COLUMNS);
+        ($ret{$asmid}{rast_result}) =
+          link_results($asm->{local_path}, $canon->{rast_result});
+      }
+    }
+
+    # ModelSEED, same as above
+    if (!$asm->{modelseed_status}) {
+      if ($canon->{modelseed_status} eq 'failed') {
+        $ret{$asmid}{$_} = $canon->{$_} for (MODELSEED_COLUMNS);
+      } elsif ($canon->{modelseed_result}) {
+        my $ms_name = $canon->{modelseed_name};
+        $ret{$asmid}{$_} = $canon->{$_} for (MODELSEED_COLUMNS);
+        link_results($asm->{local_path}, glob "$canon->{local_path}/$ms_name.*");
+        $ret{$asmid}{modelseed_result} =
+          "$asm->{local_path}/" . basename($canon->{modelseed_result});
+      }
+    }
+  }
+
+  update_records(\%ret) if %ret;
+}
+
+sub dedup_update {
+  # Given a list of asmids and worker id, links assemblies with identical
+  # sequence to a single canonical assembly and copies its results when
+  # available
+  # Duplicates are skipped by rast_submit and modelseed_submit
+  # Assignment is done under lock as other workers may be submitting
+  my ($asmids, $worker) = @_;
+  dedup_checksum(get_records(@$asmids));
+  with_records_lock(sub { dedup_assign(get_records(@$asmids), $worker) });
+  dedup_results(get_records(@$asmids));
+}
+
+1;
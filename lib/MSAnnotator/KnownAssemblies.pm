@@ -2,6 +2,7 @@ package MSAnnotator::KnownAssemblies;
 require Exporter;
 use Clone 'clone';
 use File::Basename;
+use Fcntl ':flock';
 use DBI;
 
 # Load custom modules
@@ -10,7 +11,9 @@ use MSAnnotator::Config;
 
 # Export functions
 our @ISA = 'Exporter';
-our @EXPORT_OK = qw(update_records add_records get_records);
+our @EXPORT_OK = qw(
+  update_records add_records get_records
+  with_records_lock claim_records release_records renew_claim count_running);
 
 # Order does not matter
 # Any all columns can be added or removed except:
@@ -28,6 +31,11 @@ use constant COLUMN_HEADER => (
   "modelseed_status",
   "modelseed_name",
   "modelseed_result",
+  "sequence_md5",
+  "duplicate_of",
+  "account",
+  "worker",
+  "lease_expires",
   "organism_name",
   "taxid",
   "species_taxid",
@@ -44,6 +52,8 @@ my @column_header = (COLUMN_HEADER);
 my $config = load_config();
 my $records_filename = $config->{record_filename};
 my ($records_table, $records_path) = fileparse($records_filename);
+my $lock_filename = "$records_filename.lock";
+my ($lock_fh, $lock_depth) = (undef, 0);
 
 # Set dbh options
 my $dbh = DBI->connect("dbi:CSV:", undef, undef, {
@@ -60,6 +70,9 @@ if (! -e $records_filename) {
   chmod 0440, $records_filename;
 }
 
+# Add any new columns to a records file created by an older version
+migrate_records();
+
 # Insert statement
 my $insert_sth = $dbh->prepare(
   "INSERT INTO $records_table (" . join(", ", @column_header) . ") " .
@@ -71,15 +84,68 @@ my $update_sth = $dbh->prepare(
   "SET " . join(" = ?, ", @column_header) . " = ? " .
   "WHERE asmid = ?");
 
-# Fetch via assembly
-my $query_asmids_sth= $dbh->prepare(
-  "SELECT * FROM $records_table WHERE asmid = ?");
+# Fetch all rows, the CSV table is scanned whole for any query
+my $query_all_sth = $dbh->prepare("SELECT * FROM $records_table");
+
+sub with_records_lock {
+  # Runs code while holding an exclusive lock on the records file
+  # Shared by all workers using the same record_filename, may be nested
+  my $code = shift;
+  if ($lock_depth == 0) {
+    open($lock_fh, '>>', $lock_filename) or croak "$!: $lock_filename\n";
+    flock($lock_fh, LOCK_EX) or croak "Error - Locking $lock_filename: $!\n";
+  }
+  $lock_depth += 1;
+  my @ret = eval { $code->() };
+  my $error = $@;
+  $lock_depth -= 1;
+  if ($lock_depth == 0) {
+    flock($lock_fh, LOCK_UN);
+    close $lock_fh;
+  }
+  croak $error if $error;
+  return wantarray ? @ret : $ret[0];
+}
+
+sub migrate_records {
+  # Appends columns of COLUMN_HEADER missing from the records file header
+  # Existing rows are kept with empty values for the added columns
+  with_records_lock(sub {
+    open(my $in, '<', $records_filename) or croak "$!: $records_filename\n";
+    my $header = <$in>;
+    chomp $header;
+    my %found = map { lc $_ => 1 } split(',', $header);
+    my @missing = grep { !$found{$_} } @column_header;
+    if (!@missing) {
+      close $in;
+      return;
+    }
+
+    # Rewrite to a temporary file and move it in place
+    my $tmpfile = "$records_filename.tmp";
+    my $pad = ',' x scalar(@missing);
+    open(my $out, '>', $tmpfile) or croak "$!: $tmpfile\n";
+    print $out join(',', $header, @missing) . "\n";
+    while (my $line = <$in>) {
+      chomp $line;
+      next if $line eq '';
+      print $out $line . $pad . "\n";
+    }
+    close $in;
+    close $out or croak "$!: $tmpfile\n";
+    chmod 0440, $tmpfile;
+    rename($tmpfile, $records_filename) or croak "$!: $records_filename\n";
+    print "Added columns to $records_filename: " . join(", ", @missing) . "\n";
+  });
+}
 
 sub do_insert_records {
   my ($vals) = @_;
-  chmod 0660, $records_filename;
-  $insert_sth->execute(@{$vals}{@column_header});
-  chmod 0440, $records_filename;
+  with_records_lock(sub {
+    chmod 0660, $records_filename;
+    $insert_sth->execute(@{$vals}{@column_header});
+    chmod 0440, $records_filename;
+  });
 }
 
 sub do_update_records {
@@ -104,22 +170,42 @@ sub do_update_records {
 
   # Do the update
   $update_sth = $dbh->prepare_cached($statement);
-  chmod 0660, $records_filename;
-  $update_sth->execute(@update_vals, $asmid);
-  chmod 0440, $records_filename;
+  with_records_lock(sub {
+    chmod 0660, $records_filename;
+    $update_sth->execute(@update_vals, $asmid);
+    chmod 0440, $records_filename;
+  });
+}
+
+sub do_update_many {
+  # Sets the same values on all given asmids with a single update
+  my ($asmids, $values) = @_;
+  my @update_cols = grep { $_ ne 'asmid' && exists $values->{$_} } @column_header;
+  my $statement = "UPDATE $records_table " .
+    "SET " . join(" = ?, ", @update_cols) . " = ? " .
+    "WHERE asmid IN (" . join(", ", ('?') x @$asmids) . ")";
+  my $sth = $dbh->prepare($statement);
+  with_records_lock(sub {
+    chmod 0660, $records_filename;
+    $sth->execute(@{$values}{@update_cols}, @$asmids);
+    chmod 0440, $records_filename;
+  });
 }
 
 sub get_records {
   # Given a list of asmids, returns hash of all rows of know_assemblies
   # Return hash is keyed by asmid
+  # Rows are collected in a single pass over the records file
   my @asmids = @_;
+  my %wanted = map { $_ => 1 } @asmids;
   my %ret;
-  for my $asmid (@asmids) {
-    $query_asmids_sth->execute($asmid);
-    while (my $res = $query_asmids_sth->fetchrow_hashref) {
-      $ret{$res->{asmid}} = clone($res);
+  return \%ret if !@asmids;
+  with_records_lock(sub {
+    $query_all_sth->execute;
+    while (my $res = $query_all_sth->fetchrow_hashref) {
+      $ret{$res->{asmid}} = clone($res) if $wanted{$res->{asmid}};
     }
-  }
+  });
   return \%ret;
 }
 
@@ -134,14 +220,14 @@ sub add_records {
     $asmids->{$asmid}->{asmid} = $asmid if !exists $asmids->{$asmid}->{asmid};
   }
 
-  # Check records assemblies
-  my $records = get_records(keys %$asmids);
-  my @found = map { $_ if exists($records->{$_}) } keys %$records;
-  my $err = "Error: Found already existing entry for: ". join("\n  ", @found);
-  croak $err if (scalar(@found) > 0);
-
-  # Add values
-  do_insert_records($_) for values %$asmids;
+  # Check records assemblies and add values, other workers may be adding too
+  with_records_lock(sub {
+    my $records = get_records(keys %$asmids);
+    my @found = map { $_ if exists($records->{$_}) } keys %$records;
+    my $err = "Error: Found already existing entry for: ". join("\n  ", @found);
+    croak $err if (scalar(@found) > 0);
+    do_insert_records($_) for values %$asmids;
+  });
 }
 
 sub update_records {
@@ -166,4 +252,128 @@ sub update_records {
   }
 }
 
+sub record_finished {
+  # True if no remote work is left for this record
+  # Duplicates are only finished if they never were sent to RAST
+  my $asm = shift;
+  return $asm->{rast_status} eq 'failed' ||
+    $asm->{modelseed_status} eq 'failed' ||
+    $asm->{modelseed_result} ||
+    ($asm->{duplicate_of} && !$asm->{rast_jobid});
+}
+
+sub record_account {
+  # Returns the account owning the record
+  # Records submitted before accounts were recorded belong to the
+  # user of the default credentials file
+  my $asm = shift;
+  return $asm->{account} if $asm->{account};
+  return $asm->{rast_jobid} ? $config->{default_account} : '';
+}
+
+sub claim_records {
+  # Given asmids, worker id, account, lease time in seconds and maxjobs
+  # Renews leases already held by worker and claims unleased records:
+  #   * Records with a rast_jobid are only claimed by workers of the
+  #     account owning the remote jobs, this recovers claims of dead workers
+  #     Records without an account belong to default_account
+  #   * Records without a rast_jobid are claimed while the account has less
+  #     than maxjobs running or claimed submissions
+  # Finished records are released
+  # Returns list of asmids claimed by worker
+  # The records file is read once and claims / releases written at once
+  my ($asmids, $worker, $account, $lease, $maxjobs) = @_;
+  my $now = time;
+  my (@ret, @release);
+
+  with_records_lock(sub {
+    my $records = get_records(@$asmids);
+
+    # Determine available submission slots for account
+    my $used = 0;
+    for my $asm (values %$records) {
+      next if record_account($asm) ne $account || record_finished($asm);
+      if ($asm->{rast_status} eq 'running') {
+        $used += 1;
+      } elsif (!$asm->{rast_jobid} && ($asm->{lease_expires} || 0) > $now) {
+        $used += 1;
+      }
+    }
+    my $slots = $maxjobs - $used;
+
+    for my $asmid (sort keys %$records) {
+      my $asm = $records->{$asmid};
+      my $held = $asm->{worker} eq $worker;
+      my $leased = $asm->{worker} && ($asm->{lease_expires} || 0) > $now;
+
+      if (record_finished($asm)) {
+        push(@release, $asmid) if $held;
+        next;
+      }
+      next if $leased && !$held;
+
+      if ($asm->{rast_jobid}) {
+        # Remote jobs can only be seen by the submitting account
+        next if record_account($asm) ne $account;
+      } elsif (!($held && $leased && $asm->{account} eq $account)) {
+        # New submission, requires a free slot
+        next if $maxjobs != 0 && $slots <= 0;
+        $slots -= 1;
+      }
+
+      push(@ret, $asmid);
+    }
+
+    do_update_many(\@ret, {
+      account => $account,
+      worker => $worker,
+      lease_expires => $now + $lease}) if @ret;
+    do_update_many(\@release, {worker => '', lease_expires => ''}) if @release;
+  });
+
+  return @ret;
+}
+
+sub release_records {
+  # Given asmids and worker id, releases all claims held by worker
+  my ($asmids, $worker) = @_;
+  with_records_lock(sub {
+    my $records = get_records(@$asmids);
+    my @release = grep { $records->{$_}->{worker} eq $worker } keys %$records;
+    do_update_many(\@release, {worker => '', lease_expires => ''}) if @release;
+  });
+}
+
+sub renew_claim {
+  # Given asmid, worker id and lease time in seconds, renews the lease if
+  # worker still holds it
+  # Returns the current record, or nothing if the lease expired or was taken
+  # Called right before submitting remote jobs, as a lease can run out while
+  # a worker is busy and the record then be claimed by another worker
+  my ($asmid, $worker, $lease) = @_;
+  my $now = time;
+  return with_records_lock(sub {
+    my $asm = get_records($asmid)->{$asmid};
+    return if !$asm || $asm->{worker} ne $worker ||
+      ($asm->{lease_expires} || 0) <= $now;
+    $asm->{lease_expires} = $now + $lease;
+    do_update_records($asmid, {lease_expires => $asm->{lease_expires}});
+    return $asm;
+  });
+}
+
+sub count_running {
+  # Given a status column and account, returns the number of records of
+  # account running in that column, over the whole records file
+  my ($column, $account) = @_;
+  my $ret = 0;
+  with_records_lock(sub {
+    $query_all_sth->execute;
+    while (my $res = $query_all_sth->fetchrow_hashref) {
+      $ret += 1 if $res->{$column} eq 'running' && record_account($res) eq $account;
+    }
+  });
+  return $ret;
+}
+
 1;
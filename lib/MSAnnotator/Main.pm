@@ -2,14 +2,17 @@ package MSAnnotator::Main;
 use Clone 'clone';
 use POSIX 'strftime';
 use Text::Table;
+use Fcntl ':flock';
 
 # Load custom modules
 use MSAnnotator::Base;
 use MSAnnotator::Config;
 use MSAnnotator::NCBI qw(get_input_asmids get_new_asmids  add_asmids);
-use MSAnnotator::KnownAssemblies qw(update_records add_records get_records);
+use MSAnnotator::KnownAssemblies qw(
+  update_records add_records get_records claim_records release_records);
 use MSAnnotator::RAST qw(rast_update_status rast_get_results rast_submit);
 use MSAnnotator::ModelSEED qw(modelseed_update_status modelseed_submit modelseed_get_results);
+use MSAnnotator::Dedup qw(dedup_update);
 
 # Export functions
 require Exporter;
@@ -17,11 +20,14 @@ our @ISA = 'Exporter';
 our @EXPORT_OK = qw(main);
 
 sub get_status {
-  my ($input, $asmids) = @_;
+  # Status is combined over all workers sharing the records file
+  # claimed is the number of assemblies held by this worker
+  my ($input, $asmids, $worker) = @_;
   my $records = get_records(@$asmids);
   my @rescols = qw(
     date taxids_input taxids_found ms_complete
-    rast_complete running failed pending);
+    rast_complete running failed pending duplicates workers claimed);
+  my %workers;
 
   # Number of input taxids found
   my %res = map { $_ => 0 } @rescols;
@@ -38,7 +44,12 @@ sub get_status {
     $res{failed} += 1 if $asm->{modelseed_status} eq "failed";
     $res{pending} += 1 if !$asm->{rast_status};
     $res{pending} += 1 if !$asm->{modelseed_status};
+    $res{duplicates} += 1 if $asm->{duplicate_of};
+    $res{claimed} += 1 if $asm->{worker} eq $worker;
+    $workers{$asm->{worker}} = 1
+      if $asm->{worker} && ($asm->{lease_expires} || 0) > time;
   }
+  $res{workers} = scalar keys %workers;
 
   return \%res
 }
@@ -51,7 +62,7 @@ sub print_status {
 
   my @header_columns = qw(
     date taxids_input taxids_found ms_complete
-    rast_complete running failed pending);
+    rast_complete running failed pending duplicates workers claimed);
   my @header = map { $_ . "\n" . "-" x length($_) } @header_columns;
   $header[0] = "";
 
@@ -65,9 +76,36 @@ sub print_status {
   }
 }
 
+sub run_python_stage {
+  # Runs a python module from FigKernelPackages on the records file
+  # Used to load new RAST / MS results into local stores
+  # Holds a lock on the store so that only one worker updates it at a time
+  # Skipped if another worker is updating it, it is caught up on a later pass
+  my ($module, $records_filename, $target) = @_;
+  my $script = "${ENV{'PWD'}}/include/SEED/FigKernelPackages/$module.py";
+  my $lock_filename = "$target.lock";
+  open(my $lock_fh, '>>', $lock_filename) or croak "$!: $lock_filename\n";
+  if (!flock($lock_fh, LOCK_EX | LOCK_NB)) {
+    close $lock_fh;
+    print "Skipping $module, $target is being updated by another worker\n";
+    return;
+  }
+  system("python", $script, $records_filename, $target) == 0
+    or carp "Warning - Running $module failed: $?\n";
+  close $lock_fh;
+}
+
 sub remote_tasks {
   my ($asmidref, $config) = @_;
-  my @asmids = @$asmidref;
+  my @input_asmids = @$asmidref;
+
+  # Claim assemblies to work on, other workers may share the records file
+  my @asmids = claim_records(
+    \@input_asmids,
+    $config->{worker_id},
+    $config->{account},
+    $config->{lease_time},
+    $config->{rast_maxjobs});
 
   # Get current RAST / MS  status and update assembly_records
   rast_update_status(@asmids);
@@ -76,13 +114,24 @@ sub remote_tasks {
   # Download complete RAST / MS analyses
   rast_get_results(@asmids);
   modelseed_get_results(@asmids);
+  run_python_stage("RASTFeatures",
+    $config->{record_filename}, $config->{feature_store})
+    if $config->{feature_store};
+  run_python_stage("ModelSEEDMatrix",
+    $config->{record_filename}, $config->{model_matrix})
+    if $config->{model_matrix};
+
+  # Link identical assemblies and copy their results, skipping submission
+  dedup_update(\@input_asmids, $config->{worker_id});
 
   # Make submisions
-  rast_submit(\@asmids, $config->{rast_maxjobs});
-  modelseed_submit(\@asmids, $config->{modelseed_maxjobs});
+  rast_submit(\@asmids, $config->{rast_maxjobs},
+    $config->{worker_id}, $config->{lease_time});
+  modelseed_submit(\@asmids, $config->{modelseed_maxjobs},
+    $config->{worker_id}, $config->{lease_time});
 
   # Get status
-  return get_status($config->{taxid_input}, \@asmids);
+  return get_status($config->{taxid_input}, \@input_asmids, $config->{worker_id});
 }
 
 sub main {
@@ -105,6 +154,7 @@ sub main {
     print_status(status => $status, print_header => 0);
   }
 
+  release_records(\@asmids, $config->{worker_id});
   say "All jobs completed!";
 }
 
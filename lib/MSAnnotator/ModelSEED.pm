@@ -8,8 +8,10 @@ use JSON qw(encode_json decode_json);
 
 # Load custom modules
 use MSAnnotator::Base;
+use MSAnnotator::Config;
 use MSAnnotator::Util qw(download_url);
-use MSAnnotator::KnownAssemblies qw(update_records get_records);
+use MSAnnotator::KnownAssemblies qw(
+  update_records get_records with_records_lock renew_claim count_running);
 
 # Export functions
 our @ISA = 'Exporter';
@@ -20,7 +22,7 @@ my $modelseed_url = "http://p3c.theseed.org/dev1/services/ProbModelSEED";
 my $workspace_url = "http://p3.theseed.org/services/Workspace";
 my $fba_url = "http://bio-data-1.mcs.anl.gov/services/ms_fba";
 my $auth_url = "http://tutorial.theseed.org/Sessions/Login";
-my $credential_file = "credentials.yaml";
+my $credential_file = load_config()->{credentials_file};
 my ($user, $token) = authenticate();
 
 sub authenticate {
@@ -269,16 +271,6 @@ sub modelseed_update_status {
   return \%ret;
 }
 
-sub modelseed_get_inprogress {
-  my $asmids = shift;
-  my $records = get_records(@$asmids);
-  my $ret = 0;
-  for my $asm (values(%$records)) {
-    $ret += 1 if $asm->{modelseed_status} eq 'running';
-  }
-  return $ret
-}
-
 sub modelseed_submit {
   # Given list of assembly ids
   # Checks records for rast_taxids that need model reconstruction run
@@ -286,14 +278,30 @@ sub modelseed_submit {
   # NOTE:
   #   modelseed_status could already be set to failed
   #   via modelseed_update_status
-  my ($asmids, $maxjobs) = @_;
+  #   maxjobs applies to all running jobs of the account, a slot is reserved
+  #   under lock by setting modelseed_status before submitting
+  my ($asmids, $maxjobs, $worker, $lease) = @_;
   my $records = get_records(@$asmids);
 
   while (my ($asmid, $asm) = each %$records) {
     next if $asm->{rast_status} ne "complete" || $asm->{modelseed_jobid};
     next if $asm->{modelseed_status} eq "failed" || ! $asm->{rast_taxid};
-    my $ms_inprogress = modelseed_get_inprogress($asmids);
-    last if $ms_inprogress >= $maxjobs && $maxjobs != 0;
+    next if $asm->{duplicate_of};
+
+    # Check worker still holds the lease and account has a free slot
+    # A record left running without jobid already holds its slot
+    my $reserved = with_records_lock(sub {
+      my $current = renew_claim($asmid, $worker, $lease);
+      return 'lost' if !$current || $current->{modelseed_jobid};
+      if ($current->{modelseed_status} ne 'running') {
+        return 'full' if $maxjobs != 0 &&
+          count_running('modelseed_status', $current->{account}) >= $maxjobs;
+        update_records({$asmid => {modelseed_status => 'running'}});
+      }
+      return 'ok';
+    });
+    last if $reserved eq 'full';
+    next if $reserved ne 'ok';
 
     my $rast_id = $asm->{rast_taxid};
     my $ms_name = "MS$rast_id";
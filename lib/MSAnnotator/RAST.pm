@@ -7,7 +7,8 @@ use RASTserver;
 
 # Load custom modules
 use MSAnnotator::Base;
-use MSAnnotator::KnownAssemblies qw(update_records get_records);
+use MSAnnotator::Config;
+use MSAnnotator::KnownAssemblies qw(update_records get_records renew_claim);
 
 # Export functions
 require Exporter;
@@ -19,7 +20,8 @@ use constant genbank_suffix => "_genomic.gbff";
 
 # Load credentials
 # NOTE RASTserver.pm will die uppon catching an error
-my ($user, $password) = @{LoadFile("credentials.yaml")}{qw(user password)};
+my $credential_file = load_config()->{credentials_file};
+my ($user, $password) = @{LoadFile($credential_file)}{qw(user password)};
 my $rast_client = RASTserver->new($user, $password);
 
 sub rast_update_status {
@@ -122,7 +124,8 @@ sub rast_submit {
   #   --rasttk           => Use RASTtk pipeline instead of "Classic RAST."
   #  NOTE:
   #   This does not check to ensure that genes are present in gbff file
-  my ($asmids, $maxjobs) = @_;
+  #   Each record is only submitted if worker still holds its lease
+  my ($asmids, $maxjobs, $worker, $lease) = @_;
   my $records = get_records(@$asmids);
 
   # Rast options
@@ -136,6 +139,7 @@ sub rast_submit {
   # Get ids that need a rast submission
   my @submit;
   for my $asmid (keys %$records) {
+    next if $records->{$asmid}->{duplicate_of};
     push(@submit, $asmid) if !$records->{$asmid}->{rast_jobid};
   }
 
@@ -151,6 +155,11 @@ sub rast_submit {
     my $gbfile = "$asm->{local_path}/$asmid" . genbank_suffix;
     croak "Error - Could not find: $gbfile" if ! -e $gbfile;
 
+    # Lease may have run out meanwhile and the record been claimed, or linked
+    # as a duplicate, by another worker
+    my $current = renew_claim($asmid, $worker, $lease);
+    next if !$current || $current->{duplicate_of} || $current->{rast_jobid};
+
     # Need to pass file, taxid, and organism name
     my $params = {
       -file => $gbfile,
@@ -165,7 +174,8 @@ sub rast_submit {
         $asmid => {
           rast_jobid => $res->{job_id},
           rast_status => 'running',
-          rast_taxid => ''});
+          rast_taxid => '',
+          account => $user});
       update_records(\%rast_update);
     } else {
       croak "Error - Durring RAST submission for $asmid";
@@ -3,5 +3,10 @@
 # Load environment and add lib to PERL5LIB
 source bin/setenv.sh
 
+# Optional credentials file, allows running one worker per account
+if [ -n "$1" ]; then
+  export MSANNOTATOR_CREDENTIALS="$(readlink -f "$1")"
+fi
+
 perl -I$(pwd)/lib -e 'use MSAnnotator::Main qw(main); main();'
 